@@ -0,0 +1,209 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+
+import aiohttp
+
+logger = logging.getLogger("aiohttp_proxy")
+
+# Capture files are JSON Lines: one upstream exchange per line, appended as it
+# completes. Each record holds the request key, the response status and headers,
+# and either the full body or the streamed frames with their arrival offsets.
+# Exchanges that failed while reading the upstream body carry an "error" field.
+# Exchanges the client abandoned before the upstream finished are not written,
+# since their captured body would replay as a short but clean response.
+#
+# Frame text is decoded with "surrogateescape" so chunks that split a multi-byte
+# UTF-8 sequence still round-trip to the exact bytes Azure sent.
+
+
+def request_key(deployment, body):
+    """Hash the parts of a request that determine Azure's response"""
+    canonical = json.dumps({"deployment": deployment, "body": body}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class RecordingResponse:
+    """
+    Wraps an aiohttp response and captures everything read from it.
+    """
+
+    def __init__(self, response, key, started):
+        self._response = response
+        self.key = key
+        self._started = started
+        self._headers_at = time.monotonic() - started
+        self._body = None
+        self._frames = []
+        self._error = None
+        self._exhausted = False
+        self.status = response.status
+        self.headers = response.headers
+        self.content = self
+
+    async def text(self):
+        try:
+            text = await self._response.text()
+        except Exception as e:
+            self._error = str(e) or type(e).__name__
+            raise
+        self._body = text
+        return text
+
+    async def iter_any(self):
+        try:
+            async for chunk in self._response.content.iter_any():
+                offset = round(time.monotonic() - self._started, 4)
+                self._frames.append([offset, chunk.decode("utf-8", "surrogateescape")])
+                yield chunk
+            self._exhausted = True
+        except Exception as e:
+            self._error = str(e) or type(e).__name__
+            raise
+
+    @property
+    def complete(self):
+        """Whether the upstream body was read to its end or failed with an error"""
+        if self._error is not None or self._body is not None or self._exhausted:
+            return True
+        # Streams are left at their [DONE] line, which may be split across chunks
+        return "data: [DONE]" in "".join(text for _, text in self._frames[-2:])
+
+    def to_record(self):
+        record = {
+            "key": self.key,
+            "status": self.status,
+            "headers": dict(self.headers),
+            "timing": {
+                "headers": round(self._headers_at, 4),
+                "done": round(time.monotonic() - self._started, 4),
+            },
+        }
+        if self._frames:
+            record["frames"] = self._frames
+        else:
+            record["body"] = self._body
+        if self._error is not None:
+            record["error"] = self._error
+        return record
+
+
+class Recorder:
+    """
+    Appends recorded exchanges to a capture file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+
+    def wrap(self, response, key, started):
+        return RecordingResponse(response, key, started)
+
+    def write(self, recording):
+        if not recording.complete:
+            logger.warning(f"Not recording exchange {recording.key}: client disconnected before it completed")
+            return
+        self._file.write(json.dumps(recording.to_record(), separators=(",", ":")) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class ReplayResponse:
+    """
+    Serves a recorded exchange through the same interface as an aiohttp response.
+
+    With speed 0 everything is returned immediately; otherwise the recorded
+    timing is reproduced, divided by speed (1.0 is real time, 2.0 twice as fast).
+    Recorded upstream failures are raised again once the captured data is served.
+    """
+
+    def __init__(self, record, speed, started):
+        self._record = record
+        self._speed = speed
+        self._started = started
+        self.status = record["status"]
+        self.headers = record["headers"]
+        self.content = self
+
+    async def _wait_until(self, offset):
+        if self._speed <= 0:
+            return
+        delay = offset / self._speed - (time.monotonic() - self._started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def wait_headers(self):
+        await self._wait_until(self._record["timing"]["headers"])
+
+    def _raise_recorded_error(self):
+        if "error" in self._record:
+            raise aiohttp.ClientPayloadError(self._record["error"])
+
+    async def text(self):
+        await self._wait_until(self._record["timing"]["done"])
+        self._raise_recorded_error()
+        if "frames" in self._record:
+            return "".join(text for _, text in self._record["frames"])
+        return self._record.get("body") or ""
+
+    async def iter_any(self):
+        for offset, text in self._record.get("frames", []):
+            await self._wait_until(offset)
+            yield text.encode("utf-8", "surrogateescape")
+        await self._wait_until(self._record["timing"]["done"])
+        self._raise_recorded_error()
+
+
+class ReplayIndex:
+    """
+    Index of a capture file mapping request keys to record offsets.
+
+    Only offsets are kept in memory; records are read from disk on lookup.
+    Repeated recordings of the same request are served in order, cycling.
+    Unreadable lines, such as one torn by a recorder killed mid-write, are skipped.
+    """
+
+    def __init__(self, path, speed=0):
+        self.path = path
+        self.speed = speed
+        self._offsets = {}
+        self._cursors = {}
+        self._file = open(path, "rb")
+        while True:
+            offset = self._file.tell()
+            line = self._file.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            try:
+                key = json.loads(line)["key"]
+            except (ValueError, KeyError, TypeError):
+                logger.warning(f"Skipping unreadable capture record at byte {offset} of {path}")
+                continue
+            self._offsets.setdefault(key, []).append(offset)
+
+    def __len__(self):
+        return sum(len(offsets) for offsets in self._offsets.values())
+
+    async def lookup(self, key):
+        """Return a ReplayResponse for key, or None if it was never recorded"""
+        started = time.monotonic()
+        offsets = self._offsets.get(key)
+        if not offsets:
+            return None
+        cursor = self._cursors.get(key, 0)
+        self._cursors[key] = (cursor + 1) % len(offsets)
+        self._file.seek(offsets[cursor])
+        record = json.loads(self._file.readline())
+        response = ReplayResponse(record, self.speed, started)
+        await response.wait_headers()
+        return response
+
+    def close(self):
+        self._file.close()
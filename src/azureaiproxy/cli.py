@@ -10,6 +10,10 @@ from dotenv import load_dotenv
 import signal
 import asyncio
 import argparse
+import time
+from typing import Optional
+
+from azureaiproxy.capture import Recorder, ReplayIndex, request_key
 
 # === Logging Configuration ===
 log_dir = Path("logs")
@@ -41,16 +45,61 @@ AZURE_OPENAI_DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT", "o4-mini")
 AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY", "")
 AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION", "2024-05-01")
 AZURE_TIMEOUT = int(os.getenv("AZURE_TIMEOUT", 60))  # seconds
+AZURE_PROBE_TIMEOUT = int(os.getenv("AZURE_PROBE_TIMEOUT", 10))  # seconds
+AZURE_CONNECTION_LIMIT = int(os.getenv("AZURE_CONNECTION_LIMIT", 0))  # 0 means unlimited
+AZURE_DRAIN_TIMEOUT = 2  # seconds to finish reading a response so its connection is reused
+
+# === Upstream connection preferences (overridable by argparse) ===
+WARM_CONNECTIONS = int(os.getenv("AZURE_WARM_CONNECTIONS", 1))
+PROBE_INTERVAL = int(os.getenv("AZURE_PROBE_INTERVAL", 30))  # seconds, 0 disables
 
 # === Logging preferences (set by argparse) ===
 LOG_HEADERS = False
 LOG_BODIES = False
 
+# === Record/replay preferences (set by argparse) ===
+RECORD_PATH = None
+REPLAY_PATH = None
+REPLAY_SPEED = 0.0  # 0 replays at full speed, 1.0 in real time
+
+# === Application state keys ===
+AZURE_SESSION_KEY = web.AppKey("azure_session", aiohttp.ClientSession)
+UPSTREAM_HEALTH_KEY = web.AppKey("upstream_health", dict)
+PROBE_TASK_KEY = web.AppKey("probe_task", asyncio.Task)
+RECORDER_KEY = web.AppKey("recorder", Optional[Recorder])
+REPLAY_INDEX_KEY = web.AppKey("replay_index", Optional[ReplayIndex])
+
+def _get_proxy_url():
+    return os.getenv("HTTPS_PROXY") or os.getenv("HTTP_PROXY")
+
 # === Routes ===
 
 async def health_check(request):
     return web.Response(text="OK")
 
+async def readiness_check(request):
+    """
+    Reports upstream health from the cached result of the last probe round.
+    """
+    if PROBE_INTERVAL <= 0:
+        return web.json_response({"status": "ok", "probing": False})
+
+    health = request.app[UPSTREAM_HEALTH_KEY]
+    if not health:
+        return web.json_response({"status": "unknown", "error": "No probe completed yet"}, status=503)
+
+    age = time.monotonic() - health["checked_at"]
+    body = {
+        "status": "ok" if health["healthy"] else "unhealthy",
+        "upstream_status": health["status"],
+        "error": health["error"],
+        "age_seconds": round(age, 1),
+    }
+    if age > 3 * PROBE_INTERVAL:
+        body["status"] = "stale"
+        return web.json_response(body, status=503)
+    return web.json_response(body, status=200 if health["healthy"] else 503)
+
 async def proxy_chat(request):
     """
     Proxies chat completion requests to Azure OpenAI.
@@ -67,6 +116,17 @@ async def proxy_chat(request):
             logger.debug(f"Incoming request headers: {str(dict(request.headers)).strip()}")
         if LOG_BODIES:
             logger.debug(f"Incoming request body: {json.dumps(body, indent=2)}")
+
+        key = request_key(AZURE_OPENAI_DEPLOYMENT, body)
+        replay_index = request.app[REPLAY_INDEX_KEY]
+        if replay_index is not None:
+            logger.info(f"{datetime.now()} - Replaying recorded exchange {key} (stream={stream})")
+            azure_response = await replay_index.lookup(key)
+            if azure_response is None:
+                logger.error(f"No recorded exchange for request {key}")
+                return web.json_response({"error": f"No recorded exchange for request {key}"}, status=404)
+            return await _handle_azure_response(azure_response, stream, request)
+
         logger.info(f"{datetime.now()} - Forwarding request to Azure (stream={stream})")
 
         azure_url = f"{AZURE_OPENAI_ENDPOINT}/openai/deployments/{AZURE_OPENAI_DEPLOYMENT}/chat/completions"
@@ -81,50 +141,75 @@ async def proxy_chat(request):
         logger.debug(f"Using URL: {azure_url}")
 
         # === Proxy configuration ===
-        proxy_url = os.getenv("HTTPS_PROXY") or os.getenv("HTTP_PROXY")
+        proxy_url = _get_proxy_url()
         if proxy_url:
             logger.debug(f"Using proxy: {proxy_url}")
         else:
             logger.debug("No proxy configured.")
 
-        timeout = aiohttp.ClientTimeout(total=AZURE_TIMEOUT)
-        connector = aiohttp.TCPConnector(ssl=False)  # use ssl=True if proxy has valid cert
-
-        async with aiohttp.ClientSession(headers=headers, timeout=timeout, connector=connector) as session:
-            request_kwargs = {
-                "params": params,
-                "json": body,
-            }
-            if proxy_url:
-                request_kwargs["proxy"] = proxy_url
-            if LOG_HEADERS:
-                logger.debug(f"Outgoing request headers: {headers}")
-            if LOG_BODIES:
-                logger.debug(f"Outgoing request body: {json.dumps(body, indent=2)}")
-            logger.debug(f"Outgoing request: url={azure_url}, params={params}, proxy={request_kwargs.get('proxy')}")
-
-            async with session.post(azure_url, **request_kwargs) as azure_response:
-                logger.debug(f"Azure response status: {azure_response.status}")
-                if LOG_HEADERS:
-                    logger.debug(f"Azure response headers: {dict(azure_response.headers)}")
-                if azure_response.status != 200:
-                    error_detail = await azure_response.text()
-                    logger.error(f"Azure returned non-200: {azure_response.status} - {error_detail}")
-                    return web.json_response(
-                        {"error": f"Azure error {azure_response.status}: {error_detail}"},
-                        status=azure_response.status
-                    )
-
-                if not stream:
-                    return await _handle_non_streaming(azure_response)
-
-                return await _handle_streaming(azure_response, request)
+        # Shared session so requests reuse pre-warmed upstream connections
+        session = request.app[AZURE_SESSION_KEY]
+        request_kwargs = {
+            "params": params,
+            "json": body,
+            "headers": headers,
+        }
+        if proxy_url:
+            request_kwargs["proxy"] = proxy_url
+        if LOG_HEADERS:
+            logger.debug(f"Outgoing request headers: {headers}")
+        if LOG_BODIES:
+            logger.debug(f"Outgoing request body: {json.dumps(body, indent=2)}")
+        logger.debug(f"Outgoing request: url={azure_url}, params={params}, proxy={request_kwargs.get('proxy')}")
+
+        recorder = request.app[RECORDER_KEY]
+        started = time.monotonic()
+        async with session.post(azure_url, **request_kwargs) as azure_response:
+            try:
+                if recorder is None:
+                    return await _handle_azure_response(azure_response, stream, request)
+                recording = recorder.wrap(azure_response, key, started)
+                try:
+                    return await _handle_azure_response(recording, stream, request)
+                finally:
+                    recorder.write(recording)
+            finally:
+                await _drain_azure_response(azure_response)
 
     except Exception as e:
         logger.exception("General proxy error occurred.")
         return web.json_response({"error": f"Internal proxy error: {e}"}, status=500)
 
 # === Azure response handlers ===
+async def _drain_azure_response(azure_response):
+    """
+    Read what is left of the upstream body, e.g. after the [DONE] line of a stream.
+
+    aiohttp only returns a connection to the pool once its response reached EOF,
+    so without this every streaming completion would close a warm connection.
+    """
+    try:
+        await asyncio.wait_for(azure_response.content.read(), timeout=AZURE_DRAIN_TIMEOUT)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        logger.debug("Could not drain Azure response; its connection will be closed.")
+
+async def _handle_azure_response(azure_response, stream, request):
+    logger.debug(f"Azure response status: {azure_response.status}")
+    if LOG_HEADERS:
+        logger.debug(f"Azure response headers: {dict(azure_response.headers)}")
+    if azure_response.status != 200:
+        error_detail = await azure_response.text()
+        logger.error(f"Azure returned non-200: {azure_response.status} - {error_detail}")
+        return web.json_response(
+            {"error": f"Azure error {azure_response.status}: {error_detail}"},
+            status=azure_response.status
+        )
+
+    if not stream:
+        return await _handle_non_streaming(azure_response)
+
+    return await _handle_streaming(azure_response, request)
+
 async def _handle_non_streaming(azure_response):
     text = await azure_response.text()
     if LOG_BODIES:
@@ -166,6 +251,15 @@ async def _process_regular_line(web_response, line):
         logger.debug(f"Azure stream line: {line}")
     await web_response.write(f"{line}\n\n".encode("utf-8"))
 
+async def _process_stream_error(web_response, message):
+    """End an already prepared streaming response after an error"""
+    try:
+        await web_response.write(f"data: [ERROR] {message}\n\n".encode("utf-8"))
+        await web_response.write_eof()
+    except ConnectionResetError:
+        logger.debug("Client disconnected before the stream error could be sent.")
+    return web_response
+
 async def _process_stream_line(web_response, line):
     """Process a single line from the streaming response"""
     if line == "data: [DONE]":
@@ -202,10 +296,117 @@ async def _handle_streaming(azure_response, request):
         return web_response
     except aiohttp.ClientError as e:
         logger.exception(f"Client error during streaming: {e}")
-        return web.json_response({"error": f"Streaming client error: {e}"}, status=500)
+        return await _process_stream_error(web_response, f"Streaming client error: {e}")
     except Exception as e:
         logger.exception(f"Unexpected streaming error: {e}")
-        return web.json_response({"error": f"Unexpected streaming error: {e}"}, status=500)
+        return await _process_stream_error(web_response, f"Unexpected streaming error: {e}")
+
+# === Upstream connection pool and health probing ===
+
+async def _probe_upstream(session):
+    """
+    Issue a lightweight request to Azure and return (healthy, status, error).
+
+    Any HTTP response below 500 proves DNS, TCP, TLS and the proxy path all
+    work. 401 and 403 still count as unhealthy, since a rejected api-key fails
+    every chat request too.
+    """
+    probe_url = f"{AZURE_OPENAI_ENDPOINT}/openai/models"
+    request_kwargs = {
+        "params": {"api-version": AZURE_OPENAI_API_VERSION},
+        "headers": {"User-Agent": "AiohttpProxy/1.0", "api-key": AZURE_OPENAI_API_KEY},
+        "timeout": aiohttp.ClientTimeout(total=AZURE_PROBE_TIMEOUT),
+    }
+    proxy_url = _get_proxy_url()
+    if proxy_url:
+        request_kwargs["proxy"] = proxy_url
+    try:
+        async with session.get(probe_url, **request_kwargs) as response:
+            await response.read()
+            healthy = response.status < 500 and response.status not in (401, 403)
+            return healthy, response.status, None
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return False, None, str(e) or type(e).__name__
+
+async def _run_probe_round(app):
+    """
+    Probe upstream over WARM_CONNECTIONS concurrent requests and cache the result.
+
+    Running the probes concurrently forces the pool to open (or keep alive)
+    that many connections, so real traffic does not pay for connection setup.
+    A round always sends at least one probe, even with WARM_CONNECTIONS at 0.
+    """
+    count = max(WARM_CONNECTIONS, 1)
+    results = await asyncio.gather(*(_probe_upstream(app[AZURE_SESSION_KEY]) for _ in range(count)))
+    healthy = any(ok for ok, _, _ in results)
+    status = next((status for _, status, _ in results if status is not None), None)
+    error = None if healthy else next((err for _, _, err in results if err), f"Azure returned {status}")
+
+    previous = app[UPSTREAM_HEALTH_KEY]
+    if not previous or previous["healthy"] != healthy:
+        if healthy:
+            logger.info(f"Upstream healthy (status={status}, warm connections={count})")
+        else:
+            logger.warning(f"Upstream unhealthy: {error}")
+    app[UPSTREAM_HEALTH_KEY].update({
+        "healthy": healthy,
+        "status": status,
+        "error": error,
+        "checked_at": time.monotonic(),
+    })
+
+async def _probe_once(app):
+    try:
+        await _run_probe_round(app)
+    except Exception:
+        logger.exception("Upstream probe round failed.")
+
+async def _probe_loop(app):
+    while True:
+        await _probe_once(app)
+        await asyncio.sleep(PROBE_INTERVAL)
+
+async def _start_capture(app):
+    if RECORD_PATH:
+        app[RECORDER_KEY] = Recorder(RECORD_PATH)
+        logger.info(f"Recording upstream exchanges to {RECORD_PATH}")
+    if REPLAY_PATH:
+        app[REPLAY_INDEX_KEY] = ReplayIndex(REPLAY_PATH, speed=REPLAY_SPEED)
+        logger.info(f"Replaying {len(app[REPLAY_INDEX_KEY])} recorded exchanges from {REPLAY_PATH}")
+
+async def _stop_capture(app):
+    if app[RECORDER_KEY] is not None:
+        app[RECORDER_KEY].close()
+    if app[REPLAY_INDEX_KEY] is not None:
+        app[REPLAY_INDEX_KEY].close()
+
+async def _start_upstream(app):
+    # Keep idle connections open longer than the probe interval so they stay warm
+    keepalive = max(PROBE_INTERVAL * 2, 15)
+    connector = aiohttp.TCPConnector(
+        ssl=False,  # use ssl=True if proxy has valid cert
+        limit=AZURE_CONNECTION_LIMIT,
+        keepalive_timeout=keepalive,
+    )
+    app[AZURE_SESSION_KEY] = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=AZURE_TIMEOUT), connector=connector
+    )
+    # Probe in the background so an unreachable upstream does not delay startup.
+    # Without a probe interval the connections are only warmed once.
+    if PROBE_INTERVAL > 0:
+        app[PROBE_TASK_KEY] = asyncio.ensure_future(_probe_loop(app))
+    elif WARM_CONNECTIONS > 0:
+        app[PROBE_TASK_KEY] = asyncio.ensure_future(_probe_once(app))
+
+async def _stop_upstream(app):
+    task = app.get(PROBE_TASK_KEY)
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    await app[AZURE_SESSION_KEY].close()
 
 # === App Initialization ===
 
@@ -213,21 +414,60 @@ def create_app():
     app = web.Application()
     app.router.add_post("/v1/chat/completions", proxy_chat)
     app.router.add_get("/healthz", health_check)
+    app.router.add_get("/readyz", readiness_check)
+    app[UPSTREAM_HEALTH_KEY] = {}  # filled in by the probe loop, read by /readyz
+    app[RECORDER_KEY] = None
+    app[REPLAY_INDEX_KEY] = None
+    app.on_startup.append(_start_capture)
+    app.on_startup.append(_start_upstream)
+    app.on_cleanup.append(_stop_upstream)
+    app.on_cleanup.append(_stop_capture)
     return app
 
 # === Graceful Shutdown ===
 
 def main():
+    global LOG_HEADERS, LOG_BODIES, WARM_CONNECTIONS, PROBE_INTERVAL
+    global RECORD_PATH, REPLAY_PATH, REPLAY_SPEED
     parser = argparse.ArgumentParser(description="Proxy server")
     parser.add_argument("--port", type=int, default=8000, help="Port to bind the server")
     parser.add_argument("--log-headers", action="store_true", help="Enable logging of HTTP headers")
     parser.add_argument("--log-bodies", action="store_true", help="Enable logging of HTTP request/response bodies")
+    parser.add_argument("--warm-connections", type=int, default=WARM_CONNECTIONS,
+                        help="Number of upstream connections to open at startup and keep warm "
+                             "(probing always uses at least one)")
+    parser.add_argument("--probe-interval", type=int, default=PROBE_INTERVAL,
+                        help="Seconds between upstream health probes (0 disables probing)")
+    capture_group = parser.add_mutually_exclusive_group()
+    capture_group.add_argument("--record", metavar="FILE",
+                               help="Append every upstream exchange to FILE for later replay")
+    capture_group.add_argument("--replay", metavar="FILE",
+                               help="Serve responses from a recorded FILE instead of Azure")
+    parser.add_argument("--replay-speed", type=float,
+                        help="Replay pacing factor: 0 for full speed (default), 1 for real time, 2 for twice as fast")
     args = parser.parse_args()
+    if args.warm_connections < 0:
+        parser.error("--warm-connections must not be negative")
+    if args.probe_interval < 0:
+        parser.error("--probe-interval must not be negative")
+    if args.replay_speed is not None:
+        if not args.replay:
+            parser.error("--replay-speed requires --replay")
+        if args.replay_speed < 0:
+            parser.error("--replay-speed must not be negative")
     
-    # Store logging preferences globally
-    global LOG_HEADERS, LOG_BODIES
+    # Store logging and upstream connection preferences globally
     LOG_HEADERS = args.log_headers
     LOG_BODIES = args.log_bodies
+    WARM_CONNECTIONS = args.warm_connections
+    PROBE_INTERVAL = args.probe_interval
+    RECORD_PATH = args.record
+    REPLAY_PATH = args.replay
+    REPLAY_SPEED = args.replay_speed or 0.0
+    if REPLAY_PATH:
+        # Replay never talks to Azure, so there is nothing to warm or probe
+        WARM_CONNECTIONS = 0
+        PROBE_INTERVAL = 0
     app = create_app()
     runner = web.AppRunner(app)
 
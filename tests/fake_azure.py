@@ -0,0 +1,71 @@
+import asyncio
+import contextlib
+import os
+import time
+from unittest.mock import patch
+
+from aiohttp import web
+
+import azureaiproxy.cli as cli_module
+
+PEERS_KEY = web.AppKey("peers", list)
+
+STREAM_FRAMES = [
+    b'data: {"choices": [{"delta": {"content": "Hel"}}]}\n',
+    b'data: {"choices": [{"delta": {"content": "lo \xc3\xa9"}}]}\n',
+    b'data: [DONE]\n',
+]
+
+
+def create_upstream(status=200, abort_stream=False):
+    """
+    Create a fake Azure app recording the connection of every request.
+
+    Streaming completions send STREAM_FRAMES 50ms apart; with abort_stream the
+    connection is dropped after the first frame.
+    """
+    upstream = web.Application()
+    upstream[PEERS_KEY] = []
+
+    async def models(request):
+        upstream[PEERS_KEY].append(request.transport.get_extra_info("peername"))
+        # Hold the response briefly so concurrent probes need separate connections
+        await asyncio.sleep(0.05)
+        return web.json_response({"data": []}, status=status)
+
+    async def chat(request):
+        upstream[PEERS_KEY].append(request.transport.get_extra_info("peername"))
+        body = await request.json()
+        if not body.get("stream"):
+            return web.json_response({"choices": [{"message": body["messages"][-1]}]})
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for frame in STREAM_FRAMES:
+            await response.write(frame)
+            if abort_stream:
+                request.transport.abort()
+                return response
+            await asyncio.sleep(0.05)
+        await response.write_eof()
+        return response
+
+    upstream.router.add_get("/openai/models", models)
+    upstream.router.add_post("/openai/deployments/{deployment}/chat/completions", chat)
+    return upstream
+
+
+@contextlib.contextmanager
+def azure_endpoint(endpoint):
+    """Point the proxy at endpoint, bypassing any proxy from the environment"""
+    with patch.object(cli_module, "AZURE_OPENAI_ENDPOINT", endpoint), \
+            patch.dict(os.environ, {"HTTPS_PROXY": "", "HTTP_PROXY": ""}):
+        yield
+
+
+async def wait_for_probe(app, timeout=5.0):
+    """Wait until the first upstream probe round has cached its result"""
+    deadline = time.monotonic() + timeout
+    while not app[cli_module.UPSTREAM_HEALTH_KEY]:
+        if time.monotonic() > deadline:
+            raise AssertionError("No upstream probe completed in time")
+        await asyncio.sleep(0.01)
@@ -0,0 +1,238 @@
+import unittest
+from unittest.mock import patch
+import asyncio
+import json
+import sys
+import os
+import tempfile
+import time
+
+# Add the src directory to the path so we can import the module
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import aiohttp
+from aiohttp.test_utils import TestClient, TestServer
+
+from azureaiproxy.capture import ReplayIndex, request_key
+import azureaiproxy.cli as cli_module
+from fake_azure import STREAM_FRAMES, azure_endpoint, create_upstream
+
+class TestCapture(unittest.TestCase):
+
+    def setUp(self):
+        # Reset global variables before each test
+        cli_module.LOG_HEADERS = False
+        cli_module.LOG_BODIES = False
+        cli_module.WARM_CONNECTIONS = 0
+        cli_module.PROBE_INTERVAL = 0
+        cli_module.RECORD_PATH = None
+        cli_module.REPLAY_PATH = None
+        cli_module.REPLAY_SPEED = 0.0
+        fd, self.capture_path = tempfile.mkstemp(suffix=".jsonl")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.capture_path)
+
+    async def _post_chat(self, client, stream):
+        body = {"messages": [{"role": "user", "content": "ping"}], "stream": stream}
+        response = await client.post("/v1/chat/completions", json=body)
+        return response.status, await response.read()
+
+    def _record(self, upstream=None):
+        """Record a streaming and a non-streaming exchange, returning proxy output"""
+        cli_module.RECORD_PATH = self.capture_path
+
+        async def run_test():
+            async with TestServer(upstream or create_upstream()) as upstream_server:
+                endpoint = str(upstream_server.make_url("")).rstrip("/")
+                with azure_endpoint(endpoint):
+                    async with TestClient(TestServer(cli_module.create_app())) as client:
+                        return [await self._post_chat(client, False), await self._post_chat(client, True)]
+
+        outputs = asyncio.run(run_test())
+        cli_module.RECORD_PATH = None
+        return outputs
+
+    def _replay(self, speed=0.0):
+        cli_module.REPLAY_PATH = self.capture_path
+        cli_module.REPLAY_SPEED = speed
+
+        async def run_test():
+            # No upstream server: replay must not contact Azure
+            with azure_endpoint("http://127.0.0.1:1"):
+                async with TestClient(TestServer(cli_module.create_app())) as client:
+                    started = time.monotonic()
+                    outputs = [await self._post_chat(client, False), await self._post_chat(client, True)]
+                    return outputs, time.monotonic() - started
+
+        result = asyncio.run(run_test())
+        cli_module.REPLAY_PATH = None
+        return result
+
+    def test_record_writes_one_line_per_exchange(self):
+        """Test that recording appends compact records with frames and timing"""
+        self._record()
+
+        with open(self.capture_path, encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+
+        self.assertEqual(len(records), 2)
+        plain, streamed = records
+        self.assertEqual(plain["status"], 200)
+        self.assertIn("ping", plain["body"])
+        self.assertNotIn("frames", plain)
+        self.assertEqual(streamed["status"], 200)
+        self.assertGreater(len(streamed["frames"]), 1)
+        offsets = [offset for offset, _ in streamed["frames"]]
+        self.assertEqual(offsets, sorted(offsets))
+        self.assertGreaterEqual(streamed["timing"]["done"], offsets[-1])
+        frame_bytes = b"".join(text.encode("utf-8", "surrogateescape") for _, text in streamed["frames"])
+        self.assertEqual(frame_bytes, b"".join(STREAM_FRAMES))
+
+    def test_record_marks_failed_stream(self):
+        """Test that a stream aborted by the upstream is recorded with an error"""
+        outputs = self._record(create_upstream(abort_stream=True))
+
+        with open(self.capture_path, encoding="utf-8") as f:
+            streamed = [json.loads(line) for line in f][1]
+
+        self.assertEqual(len(streamed["frames"]), 1)
+        self.assertIn("error", streamed)
+        # The proxy ends its own stream with an error line instead of hanging
+        status, body = outputs[1]
+        self.assertEqual(status, 200)
+        self.assertIn(b"data: [ERROR]", body)
+
+    def test_record_skips_client_disconnect(self):
+        """Test that a stream abandoned by the client is not recorded"""
+        cli_module.RECORD_PATH = self.capture_path
+
+        async def run_test():
+            async with TestServer(create_upstream()) as upstream_server:
+                endpoint = str(upstream_server.make_url("")).rstrip("/")
+                with azure_endpoint(endpoint):
+                    async with TestClient(TestServer(cli_module.create_app())) as client:
+                        body = {"messages": [{"role": "user", "content": "ping"}], "stream": True}
+                        response = await client.post("/v1/chat/completions", json=body)
+                        await response.content.readline()
+                        response.close()
+                        # Let the proxy hit the closed connection on its next write
+                        await asyncio.sleep(0.2)
+
+        asyncio.run(run_test())
+        cli_module.RECORD_PATH = None
+
+        with open(self.capture_path, encoding="utf-8") as f:
+            self.assertEqual(f.read(), "")
+
+    def test_replay_reproduces_failed_stream(self):
+        """Test that replaying a failed stream raises the recorded payload error"""
+        self._record(create_upstream(abort_stream=True))
+        with open(self.capture_path, encoding="utf-8") as f:
+            key = json.loads(f.readlines()[1])["key"]
+
+        async def run_test():
+            index = ReplayIndex(self.capture_path)
+            try:
+                response = await index.lookup(key)
+                return [chunk async for chunk in response.content.iter_any()]
+            finally:
+                index.close()
+
+        with self.assertRaises(aiohttp.ClientPayloadError):
+            asyncio.run(run_test())
+
+    def test_replay_skips_torn_record(self):
+        """Test that a partially written last line does not prevent replay"""
+        self._record()
+        with open(self.capture_path, "a", encoding="utf-8") as f:
+            f.write('{"key": "abc", "status": 2')
+
+        with patch("azureaiproxy.capture.logger") as mock_logger:
+            index = ReplayIndex(self.capture_path)
+        index.close()
+
+        self.assertEqual(len(index), 2)
+        mock_logger.warning.assert_called_once()
+
+    def test_replay_matches_recorded_output(self):
+        """Test that replay serves the same responses as the recorded run"""
+        recorded = self._record()
+
+        replayed, _ = self._replay()
+
+        self.assertEqual(replayed, recorded)
+
+    def test_replay_real_time_pacing(self):
+        """Test that replay speed reproduces recorded SSE timing"""
+        self._record()
+
+        _, full_speed = self._replay(speed=0)
+        _, real_time = self._replay(speed=1.0)
+
+        # The recorded stream spans ~0.1s between its first and [DONE] frames
+        self.assertGreaterEqual(real_time, 0.09)
+        self.assertGreater(real_time, full_speed + 0.05)
+
+    def test_replay_unknown_request(self):
+        """Test that replay returns 404 for requests missing from the capture"""
+        cli_module.REPLAY_PATH = self.capture_path
+
+        async def run_test():
+            async with TestClient(TestServer(cli_module.create_app())) as client:
+                return await self._post_chat(client, False)
+
+        status, _ = asyncio.run(run_test())
+
+        self.assertEqual(status, 404)
+
+    def test_replay_index_cycles_repeated_requests(self):
+        """Test that repeated recordings of one request are served in order"""
+        key = request_key("deployment", {"messages": []})
+        with open(self.capture_path, "w", encoding="utf-8") as f:
+            for body in ("first", "second"):
+                record = {"key": key, "status": 200, "headers": {}, "timing": {"headers": 0, "done": 0}, "body": body}
+                f.write(json.dumps(record) + "\n")
+
+        async def run_test():
+            index = ReplayIndex(self.capture_path)
+            try:
+                self.assertEqual(len(index), 2)
+                self.assertIsNone(await index.lookup(request_key("deployment", {"messages": [1]})))
+                return [await (await index.lookup(key)).text() for _ in range(3)]
+            finally:
+                index.close()
+
+        self.assertEqual(asyncio.run(run_test()), ["first", "second", "first"])
+
+    @patch('sys.argv', ['cli.py', '--replay', 'capture.jsonl', '--replay-speed', '2'])
+    @patch('azureaiproxy.cli.web')
+    @patch('azureaiproxy.cli.asyncio')
+    def test_replay_args(self, mock_asyncio, mock_web):
+        """Test that replay args are applied and disable upstream probing"""
+        cli_module.WARM_CONNECTIONS = 1
+        cli_module.PROBE_INTERVAL = 30
+        with patch('azureaiproxy.cli.logger'):
+            try:
+                cli_module.main()
+            except SystemExit:
+                pass
+
+        self.assertEqual(cli_module.REPLAY_PATH, 'capture.jsonl')
+        self.assertEqual(cli_module.REPLAY_SPEED, 2.0)
+        self.assertEqual(cli_module.WARM_CONNECTIONS, 0)
+        self.assertEqual(cli_module.PROBE_INTERVAL, 0)
+
+    @patch('azureaiproxy.cli.web')
+    @patch('azureaiproxy.cli.asyncio')
+    def test_invalid_replay_speed(self, mock_asyncio, mock_web):
+        """Test that negative or replay-less --replay-speed values are rejected"""
+        for argv in (['cli.py', '--replay', 'capture.jsonl', '--replay-speed', '-1'],
+                     ['cli.py', '--replay-speed', '2']):
+            with patch('sys.argv', argv), patch('sys.stderr'), self.assertRaises(SystemExit):
+                cli_module.main()
+
+
+if __name__ == '__main__':
+    unittest.main()
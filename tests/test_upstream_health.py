@@ -0,0 +1,203 @@
+import unittest
+from unittest.mock import patch
+import asyncio
+import sys
+import os
+
+# Add the src directory to the path so we can import the module
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import azureaiproxy.cli as cli_module
+from fake_azure import PEERS_KEY, azure_endpoint, create_upstream, wait_for_probe
+
+
+class TestUpstreamHealth(unittest.TestCase):
+
+    def setUp(self):
+        # Reset global variables before each test
+        cli_module.LOG_HEADERS = False
+        cli_module.LOG_BODIES = False
+        cli_module.WARM_CONNECTIONS = 2
+        cli_module.PROBE_INTERVAL = 30
+        cli_module.RECORD_PATH = None
+        cli_module.REPLAY_PATH = None
+
+    def _run_with_upstream(self, upstream, check):
+        async def run_test():
+            async with TestServer(upstream) as upstream_server:
+                endpoint = str(upstream_server.make_url("")).rstrip("/")
+                with azure_endpoint(endpoint):
+                    async with TestClient(TestServer(cli_module.create_app())) as client:
+                        await wait_for_probe(client.app)
+                        await check(client)
+
+        asyncio.run(run_test())
+
+    def test_startup_warms_configured_connections(self):
+        """Test that startup opens WARM_CONNECTIONS upstream connections"""
+        upstream = create_upstream()
+
+        async def check(client):
+            self.assertEqual(len(upstream[PEERS_KEY]), 2)
+            self.assertEqual(len(set(upstream[PEERS_KEY])), 2)
+
+        self._run_with_upstream(upstream, check)
+
+    def test_chat_uses_shared_upstream_session(self):
+        """Test that chat requests are forwarded over the pre-warmed session"""
+        upstream = create_upstream()
+
+        async def check(client):
+            message = {"role": "user", "content": "ping"}
+            response = await client.post("/v1/chat/completions", json={"messages": [message]})
+            body = await response.json()
+            self.assertEqual(response.status, 200)
+            self.assertEqual(body["choices"][0]["message"], message)
+            # The chat request reused one of the warm connections
+            self.assertEqual(len(upstream[PEERS_KEY]), 3)
+            self.assertEqual(len(set(upstream[PEERS_KEY])), 2)
+
+        self._run_with_upstream(upstream, check)
+
+    def test_stream_returns_connection_to_pool(self):
+        """Test that a request following a streaming completion reuses its connection"""
+        cli_module.WARM_CONNECTIONS = 1
+        upstream = create_upstream()
+
+        async def check(client):
+            for stream in (True, False, True, False):
+                body = {"messages": [{"role": "user", "content": "ping"}], "stream": stream}
+                response = await client.post("/v1/chat/completions", json=body)
+                self.assertEqual(response.status, 200)
+                await response.read()
+            self.assertEqual(len(upstream[PEERS_KEY]), 5)
+            self.assertEqual(len(set(upstream[PEERS_KEY])), 1)
+
+        self._run_with_upstream(upstream, check)
+
+    def test_readyz_ok_when_upstream_healthy(self):
+        """Test that /readyz reports OK after a successful probe"""
+        upstream = create_upstream(status=404)
+
+        async def check(client):
+            response = await client.get("/readyz")
+            body = await response.json()
+            self.assertEqual(response.status, 200)
+            self.assertEqual(body["status"], "ok")
+            self.assertEqual(body["upstream_status"], 404)
+
+        self._run_with_upstream(upstream, check)
+
+    def test_readyz_unavailable_when_api_key_rejected(self):
+        """Test that /readyz returns 503 when Azure rejects the api-key"""
+        for status in (401, 403):
+            upstream = create_upstream(status=status)
+
+            async def check(client):
+                response = await client.get("/readyz")
+                body = await response.json()
+                self.assertEqual(response.status, 503)
+                self.assertEqual(body["upstream_status"], status)
+
+            self._run_with_upstream(upstream, check)
+
+    def test_readyz_unavailable_when_upstream_fails(self):
+        """Test that /readyz returns 503 when Azure answers with a server error"""
+        upstream = create_upstream(status=502)
+
+        async def check(client):
+            response = await client.get("/readyz")
+            body = await response.json()
+            self.assertEqual(response.status, 503)
+            self.assertEqual(body["status"], "unhealthy")
+
+        self._run_with_upstream(upstream, check)
+
+    def test_readyz_unavailable_when_upstream_unreachable(self):
+        """Test that /readyz returns 503 when the upstream cannot be reached"""
+        async def run_test():
+            with azure_endpoint("http://127.0.0.1:1"):
+                async with TestClient(TestServer(cli_module.create_app())) as client:
+                    await wait_for_probe(client.app)
+                    response = await client.get("/readyz")
+                    body = await response.json()
+                    self.assertEqual(response.status, 503)
+                    self.assertIsNotNone(body["error"])
+
+        asyncio.run(run_test())
+
+    def test_readyz_ok_when_probing_disabled(self):
+        """Test that /readyz behaves like /healthz when probing is disabled"""
+        cli_module.WARM_CONNECTIONS = 0
+        cli_module.PROBE_INTERVAL = 0
+
+        async def run_test():
+            async with TestClient(TestServer(cli_module.create_app())) as client:
+                response = await client.get("/readyz")
+                self.assertEqual(response.status, 200)
+                self.assertEqual(await response.json(), {"status": "ok", "probing": False})
+
+        asyncio.run(run_test())
+
+    def test_warm_once_when_probing_disabled(self):
+        """Test that connections are warmed once in the background without probing"""
+        cli_module.PROBE_INTERVAL = 0
+        upstream = create_upstream()
+
+        async def check(client):
+            self.assertEqual(len(set(upstream[PEERS_KEY])), 2)
+
+        self._run_with_upstream(upstream, check)
+
+    def test_warm_once_failure_is_logged(self):
+        """Test that an unexpected error in the one-time warm-up does not break cleanup"""
+        cli_module.PROBE_INTERVAL = 0
+
+        async def run_test():
+            with patch('azureaiproxy.cli._run_probe_round', side_effect=RuntimeError("boom")), \
+                    patch('azureaiproxy.cli.logger') as mock_logger:
+                async with TestClient(TestServer(cli_module.create_app())) as client:
+                    await client.app[cli_module.PROBE_TASK_KEY]
+            return mock_logger
+
+        mock_logger = asyncio.run(run_test())
+
+        mock_logger.exception.assert_called_once()
+
+    def test_connection_limit(self):
+        """Test that the shared connector has no connection limit by default"""
+        async def run_test():
+            async with TestClient(TestServer(cli_module.create_app())) as client:
+                return client.app[cli_module.AZURE_SESSION_KEY].connector.limit
+
+        cli_module.WARM_CONNECTIONS = 0
+        cli_module.PROBE_INTERVAL = 0
+        self.assertEqual(asyncio.run(run_test()), 0)
+
+    @patch('sys.argv', ['cli.py', '--warm-connections', '4', '--probe-interval', '10'])
+    @patch('azureaiproxy.cli.web')
+    @patch('azureaiproxy.cli.asyncio')
+    def test_connection_args(self, mock_asyncio, mock_web):
+        """Test that warm connection and probe interval args are applied"""
+        with patch('azureaiproxy.cli.logger'):
+            try:
+                cli_module.main()
+            except SystemExit:
+                pass
+
+        self.assertEqual(cli_module.WARM_CONNECTIONS, 4)
+        self.assertEqual(cli_module.PROBE_INTERVAL, 10)
+
+    @patch('azureaiproxy.cli.web')
+    @patch('azureaiproxy.cli.asyncio')
+    def test_negative_connection_args(self, mock_asyncio, mock_web):
+        """Test that negative warm connection and probe interval values are rejected"""
+        for argv in (['cli.py', '--warm-connections', '-1'], ['cli.py', '--probe-interval', '-5']):
+            with patch('sys.argv', argv), patch('sys.stderr'), self.assertRaises(SystemExit):
+                cli_module.main()
+
+
+if __name__ == '__main__':
+    unittest.main()